@@ -1,16 +1,30 @@
 from fastapi import FastAPI, Request, Depends, HTTPException, Header
 from fastapi.responses import Response
-from pydantic import BaseModel
-from twilio.twiml.messaging_response import MessagingResponse
+from pydantic import BaseModel, TypeAdapter
+import asyncio
 import datetime
+import functools
+import hashlib
 import os
-import json
+import orjson
 import httpx
-from typing import Dict, Optional, List
+import redis.asyncio as aioredis
+from types import MappingProxyType
+from typing import Dict, Mapping, Optional, List
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 import re
+import time
 import uuid
+from xml.sax.saxutils import escape
+from aiolimiter import AsyncLimiter
+from cachetools import TTLCache
+from tenacity import (
+    retry,
+    retry_if_exception,
+    stop_after_attempt,
+    wait_random_exponential,
+)
 
 from sqlalchemy import (
     create_engine,
@@ -23,6 +37,13 @@ from sqlalchemy import (
 from sqlalchemy.orm import sessionmaker, declarative_base
 import stripe
 
+# Faster event loop for the I/O-bound webhook path (optional, like reportlab)
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
+
 # Optional PDF support (won't crash if not installed)
 try:
     from reportlab.lib.pagesizes import letter
@@ -75,16 +96,18 @@ class ShopConfig(BaseModel):
     webhook_token: str
 
 
-def load_shops() -> Dict[str, ShopConfig]:
+_SHOPS_ADAPTER = TypeAdapter(List[ShopConfig])
+
+
+def load_shops() -> Mapping[str, ShopConfig]:
     raw = os.getenv("SHOPS_JSON")
     if not raw:
-        return {}
-    data = json.loads(raw)
-    return {s["webhook_token"]: ShopConfig(**s) for s in data}
+        return MappingProxyType({})
+    shops = _SHOPS_ADAPTER.validate_json(raw)
+    return MappingProxyType({s.webhook_token: s for s in shops})
 
 
-SHOPS_BY_TOKEN: Dict[str, ShopConfig] = load_shops()
-SESSIONS: Dict[str, dict] = {}
+SHOPS_BY_TOKEN: Mapping[str, ShopConfig] = load_shops()
 
 
 def get_shop(request: Request) -> ShopConfig:
@@ -136,10 +159,142 @@ def on_startup():
     Base.metadata.create_all(bind=engine)
 
 
+# ============================================================
+# SHARED HTTP CLIENT
+# ============================================================
+
+HTTP_CLIENT: Optional[httpx.AsyncClient] = None
+
+HTTPX_MAX_CONNECTIONS = int(os.getenv("HTTPX_MAX_CONNECTIONS", "200"))
+HTTPX_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTPX_MAX_KEEPALIVE_CONNECTIONS", "100"))
+
+
+@app.on_event("startup")
+async def start_http_client():
+    global HTTP_CLIENT
+    HTTP_CLIENT = httpx.AsyncClient(
+        timeout=35,
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=HTTPX_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTPX_MAX_KEEPALIVE_CONNECTIONS,
+        ),
+    )
+    print(
+        f"HTTP client pool: max_connections={HTTPX_MAX_CONNECTIONS}, "
+        f"max_keepalive_connections={HTTPX_MAX_KEEPALIVE_CONNECTIONS}"
+    )
+
+
+@app.on_event("shutdown")
+async def close_http_client():
+    if HTTP_CLIENT is not None:
+        await HTTP_CLIENT.aclose()
+
+
+# ============================================================
+# REDIS (OPTIONAL)
+# ============================================================
+
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS: Optional[aioredis.Redis] = None
+
+ESTIMATE_CACHE_TTL = int(os.getenv("ESTIMATE_CACHE_TTL", "3600"))
+LAST_ESTIMATE_TTL = int(os.getenv("LAST_ESTIMATE_TTL", "86400"))
+
+
+@app.on_event("startup")
+async def start_redis():
+    global REDIS
+    if REDIS_URL:
+        REDIS = aioredis.from_url(REDIS_URL, decode_responses=True)
+
+
+@app.on_event("shutdown")
+async def close_redis():
+    if REDIS is not None:
+        await REDIS.aclose()
+
+
+def estimate_cache_key(image_urls: List[str]) -> str:
+    digest = hashlib.sha256("|".join(sorted(image_urls)).encode()).hexdigest()
+    return f"dmg:{digest}"
+
+
+async def preflight_image_urls(image_urls: List[str]) -> List[str]:
+    """Drop dead media URLs so GPT-4.1 doesn't waste time fetching them.
+
+    HEADs run in parallel (one RTT for all URLs). If every URL fails the
+    preflight, hand the originals to OpenAI rather than sending nothing.
+    """
+    results = await asyncio.gather(
+        *[HTTP_CLIENT.head(url, timeout=5) for url in image_urls],
+        return_exceptions=True,
+    )
+    good = [
+        url
+        for url, r in zip(image_urls, results)
+        if not isinstance(r, BaseException) and r.status_code < 400
+    ]
+    return good or image_urls
+
+
+# ============================================================
+# SESSIONS (REDIS-BACKED, IN-PROCESS FALLBACK)
+# ============================================================
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", "1800"))
+
+# Fallback store when Redis is not configured: bounded and self-expiring,
+# writes serialized since concurrent webhook tasks share it.
+SESSIONS: TTLCache = TTLCache(maxsize=100_000, ttl=SESSION_TTL)
+_SESSIONS_LOCK = asyncio.Lock()
+
+
+def session_key(shop: ShopConfig, from_number: str) -> str:
+    return f"sess:{shop.id}:{from_number}"
+
+
+async def get_session(shop: ShopConfig, from_number: str) -> Optional[dict]:
+    key = session_key(shop, from_number)
+    if REDIS is not None:
+        try:
+            raw = await REDIS.get(key)
+            return orjson.loads(raw) if raw else None
+        except Exception as e:
+            print("Redis session read error:", e)
+    return SESSIONS.get(key)
+
+
+async def set_session(shop: ShopConfig, from_number: str, session: dict):
+    key = session_key(shop, from_number)
+    if REDIS is not None:
+        try:
+            await REDIS.setex(key, SESSION_TTL, orjson.dumps(session))
+            return
+        except Exception as e:
+            print("Redis session write error:", e)
+    async with _SESSIONS_LOCK:
+        SESSIONS[key] = session
+
+
+async def clear_session(shop: ShopConfig, from_number: str):
+    key = session_key(shop, from_number)
+    if REDIS is not None:
+        try:
+            await REDIS.delete(key)
+            return
+        except Exception as e:
+            print("Redis session delete error:", e)
+    async with _SESSIONS_LOCK:
+        SESSIONS.pop(key, None)
+
+
 # ============================================================
 # GOOGLE CALENDAR (OPTIONAL)
 # ============================================================
 
+@functools.lru_cache(maxsize=1)
 def get_calendar_service():
     sa_path = os.getenv("GOOGLE_SERVICE_ACCOUNT_JSON")
     if not sa_path or not os.path.exists(sa_path):
@@ -151,7 +306,7 @@ def get_calendar_service():
     return build("calendar", "v3", credentials=creds)
 
 
-def create_calendar_event(shop: ShopConfig, start_dt, end_dt, phone: str):
+def _insert_calendar_event(shop: ShopConfig, start_dt, end_dt, phone: str):
     service = get_calendar_service()
     if not service or not shop.calendar_id:
         return None
@@ -171,6 +326,35 @@ def create_calendar_event(shop: ShopConfig, start_dt, end_dt, phone: str):
     return created.get("id")
 
 
+async def create_calendar_event(shop: ShopConfig, start_dt, end_dt, phone: str):
+    # googleapiclient is synchronous; run the insert off the event loop.
+    return await asyncio.to_thread(_insert_calendar_event, shop, start_dt, end_dt, phone)
+
+
+# Strong references so fire-and-forget tasks aren't garbage-collected mid-flight.
+_BG_TASKS: set = set()
+
+
+def schedule_calendar_event(shop: ShopConfig, start_dt, end_dt, phone: str):
+    task = asyncio.create_task(create_calendar_event(shop, start_dt, end_dt, phone))
+    _BG_TASKS.add(task)
+
+    def _done(t: asyncio.Task):
+        _BG_TASKS.discard(t)
+        if t.cancelled():
+            return
+        exc = t.exception()
+        if exc is not None:
+            print(
+                f"Calendar event error (shop={shop.id}, phone={phone}, "
+                f"start={start_dt.isoformat()}):",
+                exc,
+            )
+
+    task.add_done_callback(_done)
+    return task
+
+
 # ============================================================
 # HELPERS: IMAGES + VIN
 # ============================================================
@@ -179,16 +363,13 @@ VIN_PATTERN = re.compile(r"\b([A-HJ-NPR-Z0-9]{17})\b")
 
 
 def extract_image_urls(form) -> List[str]:
-    urls = []
-    i = 0
-    while True:
-        key = f"MediaUrl{i}"
-        url = form.get(key)
-        if not url:
-            break
-        urls.append(url)
-        i += 1
-    return urls
+    media = [
+        (key, value)
+        for key, value in form.multi_items()
+        if key.startswith("MediaUrl") and key[8:].isdigit() and value
+    ]
+    media.sort(key=lambda item: int(item[0][8:]))
+    return [value for _, value in media]
 
 
 def extract_vin(text: str) -> Optional[str]:
@@ -204,21 +385,7 @@ def extract_vin(text: str) -> Optional[str]:
 # AI DAMAGE ESTIMATION (MULTI-IMAGE, ONTARIO 2025)
 # ============================================================
 
-async def estimate_damage_from_images(image_urls: List[str], vin: Optional[str], shop: ShopConfig):
-    api_key = os.getenv("OPENAI_API_KEY")
-    if not api_key:
-        return {
-            "severity": "Moderate",
-            "damage_areas": [],
-            "damage_types": [],
-            "recommended_repairs": [],
-            "min_cost": 600,
-            "max_cost": 1500,
-            "confidence": 0.60,
-            "vin_used": False
-        }
-
-    prompt = """
+ESTIMATE_PROMPT = """
 You are a certified Ontario (Canada) auto-body damage estimator in the year 2025
 with 15+ years of experience. You estimate collision and cosmetic repairs
 for retail customers (not insurance DRP discounts).
@@ -319,11 +486,81 @@ Return strictly this JSON (no extra text):
 }
 """
 
-    headers = {
+ESTIMATE_SYSTEM_MSG = {"role": "system", "content": ESTIMATE_PROMPT}
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+# Client-side token bucket so SMS bursts queue smoothly at our OpenAI
+# tier limit instead of producing 429s.
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "60"))
+OPENAI_LIMITER = AsyncLimiter(max_rate=OPENAI_RPM, time_period=60)
+
+_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, httpx.TimeoutException):
+        return True
+    return (
+        isinstance(exc, httpx.HTTPStatusError)
+        and exc.response.status_code in _RETRYABLE_STATUS
+    )
+
+
+@retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_random_exponential(multiplier=0.5, max=8),
+    stop=stop_after_attempt(4),
+    reraise=True,
+)
+async def _post_openai(headers: dict, body_bytes: bytes) -> bytes:
+    async with OPENAI_LIMITER:
+        async with HTTP_CLIENT.stream(
+            "POST",
+            OPENAI_CHAT_URL,
+            headers=headers,
+            content=body_bytes,
+        ) as resp:
+            raw = await resp.aread()
+            resp.raise_for_status()
+    return raw
+
+
+@functools.lru_cache(maxsize=1)
+def _openai_headers(api_key: str) -> dict:
+    return {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json",
     }
 
+
+async def estimate_damage_from_images(image_urls: List[str], vin: Optional[str], shop: ShopConfig, from_number: Optional[str] = None):
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return {
+            "severity": "Moderate",
+            "damage_areas": [],
+            "damage_types": [],
+            "recommended_repairs": [],
+            "min_cost": 600,
+            "max_cost": 1500,
+            "confidence": 0.60,
+            "vin_used": False
+        }
+
+    cache_key = estimate_cache_key(image_urls)
+    if REDIS is not None:
+        try:
+            cached = await REDIS.get(cache_key)
+            if cached:
+                return orjson.loads(cached)
+        except Exception as e:
+            print("Redis estimate cache read error:", e)
+
+    image_urls = await preflight_image_urls(image_urls)
+
+    headers = _openai_headers(api_key)
+
     content = []
     main_text = "Analyze all uploaded vehicle damage photos and follow the instructions."
     if vin:
@@ -335,22 +572,15 @@ Return strictly this JSON (no extra text):
 
     payload = {
         "model": "gpt-4.1",
-        "messages": [
-            {"role": "system", "content": prompt},
-            {"role": "user", "content": content},
-        ],
+        "messages": [ESTIMATE_SYSTEM_MSG, {"role": "user", "content": content}],
         "response_format": {"type": "json_object"},
     }
 
     try:
-        async with httpx.AsyncClient(timeout=45) as client:
-            resp = await client.post(
-                "https://api.openai.com/v1/chat/completions",
-                headers=headers,
-                json=payload,
-            )
-        data = resp.json()
-        output = json.loads(data["choices"][0]["message"]["content"])
+        body_bytes = orjson.dumps(payload)
+        raw = await _post_openai(headers, body_bytes)
+        data = orjson.loads(raw)
+        output = orjson.loads(data["choices"][0]["message"]["content"])
 
         output.setdefault("severity", "Moderate")
         output.setdefault("damage_areas", [])
@@ -377,10 +607,35 @@ Return strictly this JSON (no extra text):
             output["min_cost"] = 600
             output["max_cost"] = 1500
 
+        if REDIS is not None:
+            try:
+                await REDIS.setex(cache_key, ESTIMATE_CACHE_TTL, orjson.dumps(output))
+                if from_number:
+                    await REDIS.setex(
+                        f"last_est:{shop.id}:{from_number}",
+                        LAST_ESTIMATE_TTL,
+                        orjson.dumps(output),
+                    )
+            except Exception as e:
+                print("Redis estimate cache write error:", e)
+
         return output
 
     except Exception as e:
         print("AI Estimator Error (Ontario calibrated):", e)
+
+        # Serve the caller's last good estimate before giving up on a
+        # generic default (e.g. during an OpenAI outage).
+        if REDIS is not None and from_number:
+            try:
+                stale = await REDIS.get(f"last_est:{shop.id}:{from_number}")
+                if stale:
+                    result = orjson.loads(stale)
+                    result["stale"] = True
+                    return result
+            except Exception as redis_err:
+                print("Redis stale-estimate read error:", redis_err)
+
         return {
             "severity": "Moderate",
             "damage_areas": [],
@@ -489,8 +744,9 @@ def require_admin(request: Request):
 # APPOINTMENT SLOTS
 # ============================================================
 
-def get_appointment_slots(n: int = 3):
-    now = datetime.datetime.now()
+@functools.lru_cache(maxsize=8)
+def _slots_for_minute(bucket: int, n: int):
+    now = datetime.datetime.fromtimestamp(bucket * 60)
     tomorrow = now + datetime.timedelta(days=1)
     hours = [9, 11, 14, 16]
 
@@ -499,7 +755,70 @@ def get_appointment_slots(n: int = 3):
         dt = tomorrow.replace(hour=h, minute=0, second=0, microsecond=0)
         if dt > now:
             slots.append(dt)
-    return slots[:n]
+    return tuple(slots[:n])
+
+
+@functools.lru_cache(maxsize=32)
+def _fmt_slot(dt: datetime.datetime) -> str:
+    return dt.strftime("%a %b %d at %I:%M %p")
+
+
+def get_appointment_slots(n: int = 3):
+    # Slots only change at minute granularity; webhook bursts within the
+    # same minute share one precomputed tuple.
+    return list(_slots_for_minute(int(time.time() // 60), n))
+
+
+# ============================================================
+# RESPONSE CACHE MIDDLEWARE (REDIS, GET ONLY)
+# ============================================================
+
+# Per-path TTLs in seconds; GET paths not listed here are never cached.
+RESPONSE_CACHE_TTLS: Dict[str, int] = {
+    "/": 30,
+}
+
+
+@app.middleware("http")
+async def response_cache(request: Request, call_next):
+    ttl = RESPONSE_CACHE_TTLS.get(request.url.path)
+    if request.method != "GET" or ttl is None or REDIS is None:
+        return await call_next(request)
+
+    key = f"resp:{request.method}:{request.url.path}:{request.url.query}"
+    try:
+        cached = await REDIS.hgetall(key)
+    except Exception as e:
+        print("Response cache read error:", e)
+        cached = None
+
+    if cached:
+        return Response(
+            content=cached["body"],
+            media_type=cached.get("media_type") or "application/json",
+            headers={"x-cache": "hit"},
+        )
+
+    response = await call_next(request)
+    if response.status_code == 200:
+        body = b"".join([chunk async for chunk in response.body_iterator])
+        try:
+            await REDIS.hset(
+                key,
+                mapping={
+                    "body": body,
+                    "media_type": response.headers.get("content-type", "application/json"),
+                },
+            )
+            await REDIS.expire(key, ttl)
+        except Exception as e:
+            print("Response cache write error:", e)
+        return Response(
+            content=body,
+            status_code=response.status_code,
+            headers=dict(response.headers),
+        )
+    return response
 
 
 # ============================================================
@@ -515,6 +834,15 @@ def root():
 # ROUTE: TWILIO SMS WEBHOOK
 # ============================================================
 
+# The reply shape is always a single <Message>; formatting one template
+# is cheaper than building a twiml object graph per webhook.
+_TWIML = "<?xml version='1.0' encoding='UTF-8'?><Response><Message>{}</Message></Response>"
+
+
+def twiml_reply(text: str) -> Response:
+    return Response(content=_TWIML.format(escape(text)), media_type="application/xml")
+
+
 @app.post("/sms-webhook")
 async def sms_webhook(request: Request, shop: ShopConfig = Depends(get_shop)):
     form = await request.form()
@@ -524,10 +852,7 @@ async def sms_webhook(request: Request, shop: ShopConfig = Depends(get_shop)):
     image_urls = extract_image_urls(form)
     vin = extract_vin(body)
 
-    reply = MessagingResponse()
-
-    session_key = f"{shop.id}:{from_number}"
-    session = SESSIONS.get(session_key)
+    session = await get_session(shop, from_number)
 
     # Booking selection flow
     if session and session.get("awaiting_time") and body in {"1", "2", "3"}:
@@ -535,27 +860,24 @@ async def sms_webhook(request: Request, shop: ShopConfig = Depends(get_shop)):
         slots = session["slots"]
 
         if 0 <= idx < len(slots):
-            chosen = slots[idx]
+            chosen = datetime.datetime.fromisoformat(slots[idx])
 
-            create_calendar_event(
+            schedule_calendar_event(
                 shop=shop,
                 start_dt=chosen,
                 end_dt=chosen + datetime.timedelta(minutes=45),
                 phone=from_number,
             )
 
-            reply.message(
-                f"Your appointment is booked for {chosen.strftime('%a %b %d at %I:%M %p')}."
-            )
-
-            session["awaiting_time"] = False
-            SESSIONS[session_key] = session
+            await clear_session(shop, from_number)
 
-            return Response(content=str(reply), media_type="application/xml")
+            return twiml_reply(
+                f"Your appointment is booked for {_fmt_slot(chosen)}."
+            )
 
     # Multi-image AI estimate
     if image_urls:
-        result = await estimate_damage_from_images(image_urls, vin, shop)
+        result = await estimate_damage_from_images(image_urls, vin, shop, from_number)
 
         estimate_id = save_estimate_to_db(shop, from_number, vin, result)
 
@@ -568,30 +890,34 @@ async def sms_webhook(request: Request, shop: ShopConfig = Depends(get_shop)):
         types = ", ".join(result["damage_types"]) if result["damage_types"] else "detailed damage types detected"
 
         slots = get_appointment_slots()
-        SESSIONS[session_key] = {"awaiting_time": True, "slots": slots}
-
-        lines = [
-            f"AI Damage Estimate for {shop.name}",
-            f"Severity: {severity}",
-            f"Estimated Cost (Ontario 2025): {cost_range}",
-            f"Panels: {areas}",
-            f"Damage Types: {types}",
-            f"Estimate ID (internal): {estimate_id}",
-        ]
-
-        if vin and result.get("vin_used"):
-            lines.append(f"VIN used for calibration: {vin}")
-
-        lines.append("")
-        lines.append("Reply with a number to book an in-person estimate:")
+        await set_session(
+            shop,
+            from_number,
+            {"awaiting_time": True, "slots": [dt.isoformat() for dt in slots]},
+        )
 
-        for i, s in enumerate(slots, 1):
-            lines.append(f"{i}) {s.strftime('%a %b %d at %I:%M %p')}")
+        vin_line = (
+            f"\nVIN used for calibration: {vin}"
+            if vin and result.get("vin_used")
+            else ""
+        )
+        slot_lines = "\n".join(f"{i}) {_fmt_slot(s)}" for i, s in enumerate(slots, 1))
+
+        body_text = (
+            f"AI Damage Estimate for {shop.name}\n"
+            f"Severity: {severity}\n"
+            f"Estimated Cost (Ontario 2025): {cost_range}\n"
+            f"Panels: {areas}\n"
+            f"Damage Types: {types}\n"
+            f"Estimate ID (internal): {estimate_id}"
+            f"{vin_line}\n\n"
+            "Reply with a number to book an in-person estimate:\n"
+            f"{slot_lines}"
+        )
 
         generate_estimate_pdf(shop, from_number, result)
 
-        reply.message("\n".join(lines))
-        return Response(content=str(reply), media_type="application/xml")
+        return twiml_reply(body_text)
 
     # Default prompt (no images)
     intro = [
@@ -602,8 +928,7 @@ async def sms_webhook(request: Request, shop: ShopConfig = Depends(get_shop)):
         "- Optional: include your 17-character VIN in the text",
     ]
 
-    reply.message("\n".join(intro))
-    return Response(content=str(reply), media_type="application/xml")
+    return twiml_reply("\n".join(intro))
 
 
 # ============================================================